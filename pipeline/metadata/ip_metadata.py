@@ -13,10 +13,12 @@
 # limitations under the License.
 """IP Metadata is a class to add network metadata to IPs."""
 
-import csv
+import concurrent.futures
 import datetime
+import functools
 import logging
-import re
+import sys
+import tempfile
 from typing import Dict, Optional, Tuple, Iterator
 
 import apache_beam.io.filesystem as apache_filesystem
@@ -36,6 +38,12 @@ LATEST_AS2CLASS_FILEPATH = "as-classifications/20200801.as2types.txt.gz"
 ORG_TO_COUNTRY_HEADER = "# format:org_id|changed|org_name|country|source"
 AS_TO_ORG_HEADER = "# format:aut|changed|aut_name|org_id|opaque_id|source"
 
+# Bytes to read from a compressed file at a time
+READ_CHUNK_SIZE = 1 << 20
+
+# All metadata about an ASN, (as_name, as_full_name, as_type, country)
+AsnRecord = Tuple[Optional[str], Optional[str], Optional[str], Optional[str]]
+
 
 def _read_compressed_file(filepath: str) -> Iterator[str]:
   """Read in a compressed file as a decompressed string iterator.
@@ -46,18 +54,23 @@ def _read_compressed_file(filepath: str) -> Iterator[str]:
       'gs://censoredplanet_geolocation/caida/as-classifications/as2types.txt.gz'
 
   Returns:
-    An generator per-line reader for the file
+    A generator per-line reader for the file, without newline chars
   """
-  f: apache_filesystem.CompressedFile = apache_filesystems.FileSystems.open(
-      filepath)
-
-  while True:
-    line = f.readline()
-    if not line:
-      f.close()
-      return
-    # Remove the newline char
-    yield str(line, "utf-8")[:-1]
+  # Reading and decoding the whole file in one go is much cheaper than many
+  # small readline calls. Lines are still sliced off lazily so only the single
+  # decoded string is held in memory, not a list of every line.
+  f: apache_filesystem.CompressedFile
+  with apache_filesystems.FileSystems.open(filepath) as f:
+    # CompressedFile.read requires a size, so read in chunks until EOF
+    text = str(b"".join(iter(lambda: f.read(READ_CHUNK_SIZE), b"")), "utf-8")
+
+  start = 0
+  while start < len(text):
+    end = text.find("\n", start)
+    if end == -1:
+      end = len(text)
+    yield text[start:end]
+    start = end + 1
 
 
 def _parse_asn_db(f: Iterator[str]) -> pyasn.pyasn:
@@ -73,12 +86,16 @@ def _parse_asn_db(f: Iterator[str]) -> pyasn.pyasn:
   # 1.0.0.0\t24\t13335
   # but pyasn wants lines in the format
   # 1.0.0.0/24\t13335
-  formatted_lines = map(
-      lambda line: re.sub(r"(.*)\t(.*)\t(.*)", r"\1/\2\t\3", line), f)
-  as_str = "\n".join(formatted_lines)
-  del formatted_lines
-
-  asn_db = pyasn.pyasn(None, ipasn_string=as_str)
+  formatted_lines = map(lambda line: line.replace("\t", "/", 1) + "\n", f)
+
+  # Stream the lines to disk and let pyasn's C loader read them from there,
+  # rather than building the whole db as one large string in memory. Writing
+  # exhausts the line reader, so the decoded file text is also freed before
+  # pyasn starts building its tree.
+  with tempfile.NamedTemporaryFile(mode="w", suffix=".dat") as db_file:
+    db_file.writelines(formatted_lines)
+    db_file.flush()
+    asn_db = pyasn.pyasn(db_file.name)
   return asn_db
 
 
@@ -124,7 +141,8 @@ def _parse_org_name_to_country_map(
 
   while line != AS_TO_ORG_HEADER:
     org_id, changed_date, org_name, country, source = line.split("|")
-    org_name_to_country_map[org_id] = (org_name, country)
+    # There are only a few hundred distinct countries, share their strings
+    org_name_to_country_map[org_id] = (org_name, sys.intern(country))
 
     line = next(f)
 
@@ -174,18 +192,69 @@ def _parse_as_to_type_map(f: Iterator[str]) -> Dict[int, str]:
     Dict {asn -> network_type}
     ex {398243 : "Enterprise", 13335: "Content", 4: "Transit/Access"}
   """
-  # filter comments
-  data_lines = [line for line in f if line[0] != "#"]
-  type_data = list(csv.reader(data_lines, delimiter="|"))
-
   as_to_type_map: Dict[int, str] = {}
-  for line in type_data:
-    asn, source, org_type = line
-    as_to_type_map[int(asn)] = org_type
+  for line in f:
+    # filter comments
+    if line[0] == "#":
+      continue
+    asn, source, org_type = line.split("|")
+    # There are only a few distinct types, share their strings
+    as_to_type_map[int(asn)] = sys.intern(org_type)
 
   return as_to_type_map
 
 
+def _get_asn2org_map(
+    cloud_data_location: str
+) -> Dict[int, Tuple[str, Optional[str], Optional[str]]]:
+  as_to_org_filename = cloud_data_location + LATEST_AS2ORG_FILEPATH
+  as_to_org_file = _read_compressed_file(as_to_org_filename)
+  return _parse_as_to_org_map(as_to_org_file)
+
+
+def _get_asn2type_map(cloud_data_location: str) -> Dict[int, str]:
+  as_to_type_filename = cloud_data_location + LATEST_AS2CLASS_FILEPATH
+  as_to_type_file = _read_compressed_file(as_to_type_filename)
+  return _parse_as_to_type_map(as_to_type_file)
+
+
+def _merge_asn_maps(as_to_org_map: Dict[int, Tuple[str, Optional[str],
+                                                   Optional[str]]],
+                    as_to_type_map: Dict[int, str]) -> Dict[int, AsnRecord]:
+  """Returns a single table of all per-ASN metadata.
+
+  Args:
+    as_to_org_map: Dict {asn -> (asn_name, readable_name, country)}
+    as_to_type_map: Dict {asn -> network_type}
+
+  Returns:
+    Dict {asn -> (asn_name, readable_name, network_type, country)}
+    ex {13335: ("CLOUDFLARENET", "Cloudflare Inc.", "Content", "US")}
+    Fields missing from either map are None
+  """
+  asn_records: Dict[int, AsnRecord] = {}
+
+  for asn in as_to_org_map.keys() | as_to_type_map.keys():
+    as_name, as_full_name, country = as_to_org_map.get(asn, (None, None, None))
+    as_type = as_to_type_map.get(asn, None)
+    asn_records[asn] = (as_name, as_full_name, as_type, country)
+
+  return asn_records
+
+
+# The org and type files don't depend on the db date, so the merged table only
+# needs to be built once per process and can be shared by every db.
+@functools.lru_cache(maxsize=1)
+def _get_asn_records(cloud_data_location: str) -> Dict[int, AsnRecord]:
+  # Fetch the org and type files concurrently, only the gcs reads and gzip
+  # inflation overlap since line parsing holds the GIL.
+  with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+    as_to_org_future = executor.submit(_get_asn2org_map, cloud_data_location)
+    as_to_type_future = executor.submit(_get_asn2type_map, cloud_data_location)
+
+  return _merge_asn_maps(as_to_org_future.result(), as_to_type_future.result())
+
+
 class IpMetadata(IpMetadataInterface):
   """A lookup table which contains network metadata about IPs."""
 
@@ -207,9 +276,16 @@ class IpMetadata(IpMetadataInterface):
     super().__init__(date, cloud_data_location, allow_previous_day)
     self.cloud_data_location = cloud_data_location
 
-    self.as_to_org_map = self._get_asn2org_map()
-    self.as_to_type_map = self._get_asn2type_map()
-    self.asn_db = self._get_asn_db(date, allow_previous_day)
+    # Load the asn table and the routeview db concurrently. Only the gcs reads
+    # and gzip inflation overlap, line parsing still holds the GIL.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+      asn_records_future = executor.submit(_get_asn_records,
+                                           cloud_data_location)
+      asn_db_future = executor.submit(self._get_asn_db, date,
+                                      allow_previous_day)
+
+    self.asn_records = asn_records_future.result()
+    self.asn_db, self.date = asn_db_future.result()
 
   def lookup(
       self, ip: str
@@ -233,30 +309,20 @@ class IpMetadata(IpMetadataInterface):
     if not asn:
       raise KeyError("Missing IP {} at {}".format(ip, self.date.isoformat()))
 
-    if asn not in self.as_to_org_map:
-      logging.warning("Missing asn %s in org name map", asn)
-    as_name, as_full_name, country = self.as_to_org_map.get(
-        asn, (None, None, None))
+    as_name, as_full_name, as_type, country = self.asn_records.get(
+        asn, (None, None, None, None))
 
-    if asn not in self.as_to_type_map:
+    # as_name and as_type are always set for asns present in their source map
+    if as_name is None:
+      logging.warning("Missing asn %s in org name map", asn)
+    if as_type is None:
       logging.warning("Missing asn %s in type map", asn)
-    as_type = self.as_to_type_map.get(asn, None)
 
     return (netblock, asn, as_name, as_full_name, as_type, country)
 
-  def _get_asn2org_map(
-      self) -> Dict[int, Tuple[str, Optional[str], Optional[str]]]:
-    as_to_org_filename = self.cloud_data_location + LATEST_AS2ORG_FILEPATH
-    as_to_org_file = _read_compressed_file(as_to_org_filename)
-    return _parse_as_to_org_map(as_to_org_file)
-
-  def _get_asn2type_map(self) -> Dict[int, str]:
-    as_to_type_filename = self.cloud_data_location + LATEST_AS2CLASS_FILEPATH
-    as_to_type_file = _read_compressed_file(as_to_type_filename)
-    return _parse_as_to_type_map(as_to_type_file)
-
-  def _get_asn_db(self, date: datetime.date,
-                  allow_previous_day: bool) -> pyasn.pyasn:
+  def _get_asn_db(
+      self, date: datetime.date,
+      allow_previous_day: bool) -> Tuple[pyasn.pyasn, datetime.date]:
     """Return an ASN database object.
 
     Args:
@@ -264,18 +330,17 @@ class IpMetadata(IpMetadataInterface):
       allow_previous_day: allow using previous routeview file
 
     Returns:
-      pyasn database
+      Tuple(pyasn database, date of the routeview file used)
 
     Raises:
       FileNotFoundError: when no allowable routeview file is found
     """
     try:
-      self.date = date
-      return self._get_dated_asn_db(self.date)
+      return (self._get_dated_asn_db(date), date)
     except FileNotFoundError as ex:
       if allow_previous_day:
-        self.date = date - datetime.timedelta(days=1)
-        return self._get_dated_asn_db(self.date)
+        previous_date = date - datetime.timedelta(days=1)
+        return (self._get_dated_asn_db(previous_date), previous_date)
 
       raise ex
 
@@ -13,7 +13,10 @@
 # limitations under the License.
 """Test IPMetadata file parsing and database access."""
 
+import datetime
+from typing import Dict, Optional, Tuple
 import unittest
+from unittest.mock import patch, MagicMock
 
 from pipeline.metadata import ip_metadata
 
@@ -84,6 +87,41 @@ class IpMetadataTest(unittest.TestCase):
     as2type_map = ip_metadata._parse_as_to_type_map(as2type_file_content)
     self.assertEqual(as2type_map, {1: "Transit/Access", 4: "Content"})
 
+  def test_merge_asn_maps(self) -> None:
+    """Test merging the org and type maps into a single asn table."""
+    as2org_map: Dict[int, Tuple[str, Optional[str], Optional[str]]] = {
+        1: ("LVLT-1", "Level 3", "US"),
+        19864: ("O1COMM", "O1.com", "US"),
+    }
+    as2type_map = {1: "Transit/Access", 4: "Content"}
+
+    asn_records = ip_metadata._merge_asn_maps(as2org_map, as2type_map)
+    self.assertEqual(
+        asn_records, {
+            1: ("LVLT-1", "Level 3", "Transit/Access", "US"),
+            4: (None, None, "Content", None),
+            19864: ("O1COMM", "O1.com", None, "US")
+        })
+
+  @patch.object(ip_metadata, "_get_asn_records", MagicMock(return_value={}))
+  def test_previous_day_routeview_file(self) -> None:
+    """Test falling back to the previous day's routeview file."""
+    asn_db = MagicMock()
+
+    def get_dated_asn_db(date: datetime.date) -> MagicMock:
+      if date == datetime.date(2020, 1, 2):
+        raise FileNotFoundError(date)
+      return asn_db
+
+    with patch.object(
+        ip_metadata.IpMetadata,
+        "_get_dated_asn_db",
+        side_effect=get_dated_asn_db):
+      db = ip_metadata.IpMetadata(datetime.date(2020, 1, 2), "", True)
+
+    self.assertEqual(db.date, datetime.date(2020, 1, 1))
+    self.assertIs(db.asn_db, asn_db)
+
   # pylint: enable=protected-access
 
 